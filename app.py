@@ -1,10 +1,19 @@
 import streamlit as st
-import requests
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 import pandas as pd
-import time
 import logging
+from logging.handlers import MemoryHandler, RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import os
+from shopify_sync import (
+    BULK_PRODUCT_THRESHOLD,
+    GRAPHQL_BATCH_SIZE,
+    MAX_WORKERS,
+    ShopifyProductSync,
+    StockSchema,
+    clean_sku,
+)
 # Set page config
 st.set_page_config(
     page_title="Wow Store Product Sync Tool",
@@ -12,199 +21,52 @@ st.set_page_config(
     #layout="wide"
 )
 # Set up logging
-logging.basicConfig(
-    filename='shopify_product_sync.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-class ShopifyProductSync:
-    def __init__(self, store_name, access_token):
-        self.store_name = store_name
-        self.access_token = access_token
-        self.base_url = f"https://{store_name}.myshopify.com/admin/api/2024-01/products.json"
-        self.headers = {
-            "Content-Type": "application/json",
-            "X-Shopify-Access-Token": access_token
-        }
-        self.location_id = self.get_location_id()
-        
-    def get_location_id(self):
-        """Get the first location ID from the store"""
-        url = f"https://{self.store_name}.myshopify.com/admin/api/2024-01/locations.json"
-        response = requests.get(url, headers=self.headers)
-
-        if response.status_code == 200:
-            locations = response.json().get('locations', [])
-            if locations:
-                location_id = locations[0]['id']
-                logging.info(f"Retrieved location ID: {location_id}")
-                return location_id
-
-        logging.error("Failed to get location ID")
-        return None
-    def set_inventory_level(self, inventory_item_id, new_quantity):
-        """Set inventory level directly using the inventory levels set endpoint"""
-        if not self.location_id:
-            logging.error("No location ID available")
-            return False
-        set_url = f"https://{self.store_name}.myshopify.com/admin/api/2024-01/inventory_levels/set.json"
-
-        data = {
-            "location_id": self.location_id,
-            "inventory_item_id": inventory_item_id,
-            "available": int(new_quantity)
-        }
-
-        try:
-            response = requests.post(set_url, headers=self.headers, json=data)
-            if response.status_code == 200:
-                logging.info(f"Successfully set inventory for item {inventory_item_id} to {new_quantity}")
-                return True
-            else:
-                logging.error(f"Failed to set inventory: Status {response.status_code}, Response: {response.text}")
-                return False
-        except Exception as e:
-            logging.error(f"Error setting inventory: {str(e)}")
-            return False
-    def process_products_to_dataframe(self, products):
-        """Convert products to DataFrame with specific columns"""
-        processed_data = []
-        for product in products:
-            for variant in product.get('variants', []):
-                product_data = {
-                    'product_id': product.get('id'),
-                    'title': product.get('title'),
-                    'variant_id': variant.get('id'),
-                    'price': float(variant.get('price', 0)),
-                    'sku': variant.get('sku'),
-                    'inventory_quantity': variant.get('inventory_quantity'),
-                    'inventory_item_id': variant.get('inventory_item_id'),
-                    'created_at': product.get('created_at'),
-                    'updated_at': product.get('updated_at'),
-                    'status': product.get('status', 'active')
-                }
-                processed_data.append(product_data)
-        df = pd.DataFrame(processed_data)
-        df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce', utc=True)
-        df['updated_at'] = pd.to_datetime(df['updated_at'], errors='coerce', utc=True)
-        return df
-    def safe_float(self, value, default=0):
-        """Safely convert value to float, handling None, NaN, and string numbers with commas"""
-        if pd.isna(value) or value == '':
-            return default
-        if isinstance(value, str):
-            value = value.replace(',', '').strip()
-        try:
-            return float(value)
-        except (ValueError, TypeError):
-            return default
-    def update_product_variant(self, variant_id, new_price, new_inventory):
-        """Update price and inventory of a product variant on Shopify"""
-        try:
-            # First, get the variant details to get the inventory_item_id
-            variant_url = f"https://{self.store_name}.myshopify.com/admin/api/2024-01/variants/{variant_id}.json"
-            variant_response = requests.get(variant_url, headers=self.headers)
-
-            if variant_response.status_code != 200:
-                logging.error(f"Failed to get variant details for {variant_id}")
-                return False
-            variant_data = variant_response.json()['variant']
-            inventory_item_id = variant_data['inventory_item_id']
-            # Update price
-            update_url = f"https://{self.store_name}.myshopify.com/admin/api/2024-01/variants/{variant_id}.json"
-            price_data = {
-                "variant": {
-                    "id": variant_id,
-                    "price": self.safe_float(new_price)
-                }
-            }
-
-            price_response = requests.put(update_url, headers=self.headers, json=price_data)
-            if price_response.status_code != 200:
-                logging.error(f"Failed to update price for variant {variant_id}")
-                return False
-            # Update inventory separately
-            inventory_success = self.set_inventory_level(inventory_item_id, new_inventory)
-
-            if inventory_success:
-                logging.info(f"Successfully updated variant {variant_id} price and inventory")
-                return True
-            else:
-                logging.error(f"Failed to update inventory for variant {variant_id}")
-                return False
-        except Exception as e:
-            logging.error(f"Error in update_product_variant: {str(e)}")
-            return False
-    def get_products(self):
-        """Retrieve products from Shopify API"""
-        try:
-            products = []
-            params = {'limit': 250}
-            page_count = 1
-            while True:
-                response = requests.get(self.base_url, headers=self.headers, params=params)
-                logging.info(f"Fetching page {page_count}")
-                if response.status_code == 200:
-                    data = response.json()
-                    current_products = data.get('products', [])
-                    products.extend(current_products)
-                    print(f"Retrieved {len(current_products)} products from page {page_count}")
-                    link_header = response.headers.get('Link', '')
-                    if 'rel="next"' not in link_header:
-                        break
-                    next_link = [l.split(';')[0].strip('<> ') for l in link_header.split(',') if 'rel="next"' in l]
-                    if not next_link:
-                        break
-                    try:
-                        params = dict(param.split('=') for param in next_link[0].split('?')[1].split('&'))
-                    except Exception as e:
-                        logging.error(f"Error parsing next page parameters: {str(e)}")
-                        break
-                    time.sleep(0.5)
-                    page_count += 1
-                elif response.status_code == 429:
-                    retry_after = int(response.headers.get('Retry-After', 10))
-                    time.sleep(retry_after)
-                    continue
-                else:
-                    logging.error(f"API request failed with status code: {response.status_code}")
-                    response.raise_for_status()
-            print(f"Successfully retrieved {len(products)} products")
-            return self.process_products_to_dataframe(products)
-
-        except Exception as e:
-            logging.error(f"Error retrieving products: {str(e)}")
-            raise
+@st.cache_resource(show_spinner=False)
+def _configure_logging():
+    """Attach the log handler once per server process rather than on every rerun"""
+    file_handler = RotatingFileHandler(
+        'shopify_product_sync.log',
+        maxBytes=5_000_000,
+        backupCount=3,
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    # Records are written in batches; errors flush the buffer straight away
+    handler = MemoryHandler(capacity=1000, flushLevel=logging.ERROR, target=file_handler)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(handler)
+    return handler
 
-    def create_product(self, title, sku, price, inventory, brand):
-        """Create a new product in Shopify with the given brand."""
-        # Convert and validate the values
-        safe_price = self.safe_float(price)
-        safe_inventory = int(self.safe_float(inventory))  # Convert to integer for inventory
-        data = {
-            "product": {
-                "title": title,
-                "status": "draft",
-                #"vendor": brand.strip() if isinstance(brand, str) else brand,  # Clean up brand name
-                "variants": [{
-                    "sku": sku,
-                    "price": safe_price,
-                    "inventory_quantity": safe_inventory,
-                    "inventory_management": "shopify",  # Enable inventory tracking
-                    "inventory_policy": "deny",  # Prevent selling when out of stock
-                    "requires_shipping": True
-                }]
-            }
-        }
-        response = requests.post(self.base_url, headers=self.headers, json=data)
-        if response.status_code == 201:
-            logging.info(f"Created new product '{title}' with SKU {sku} and Brand '{brand}'")
-            return response.json()
-        else:
-            logging.error(f"Failed to create product {title}: {response.text}")
-            return None
+_configure_logging()
+# Column layout of the uploaded stock workbook
+SCHEMA = StockSchema()
 
+@st.cache_data(ttl=300, show_spinner="Fetching Shopify catalog…")
+def _load_products(store_name, access_token):
+    """Fetch the Shopify catalog once and reuse it across Streamlit reruns"""
+    sync = ShopifyProductSync(store_name, access_token)
+    try:
+        # One bulk export beats dozens of sequential REST pages on large stores
+        product_count = sync.get_product_count()
+        if product_count and product_count > BULK_PRODUCT_THRESHOLD:
+            df = sync.get_products_bulk()
+            if df is not None:
+                return df
+        return sync.get_products()
+    finally:
+        sync.close()
 
+@st.cache_data(hash_funcs={UploadedFile: lambda f: f.file_id})
+def _read_excel(uploaded_file):
+    """Parse an uploaded workbook once per file rather than on every rerun"""
+    # calamine parses xlsx in Rust; unused columns and type inference for text columns are skipped
+    return pd.read_excel(
+        uploaded_file,
+        engine='calamine',
+        usecols=lambda column: column in SCHEMA.required_columns,
+        dtype={SCHEMA.sku_column: 'string', SCHEMA.name_column: 'string', SCHEMA.brand_column: 'string'}
+    )
 
 def main():
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -216,6 +78,7 @@ def main():
     store_name = st.secrets["store_name"]
     access_token = st.secrets["access_token"]
     
+    sync = None
     try:
         sync = ShopifyProductSync(store_name, access_token)
         if not sync.location_id:
@@ -224,100 +87,167 @@ def main():
             
         st.write("Sync and update product prices and inventory on Shopify with a simple Excel upload. Automatically update existing products and create new ones as drafts if missing. Track progress in real time! 🚀")
                  
+        if st.button("Refresh catalog"):
+            _load_products.clear()
+
         uploaded_file = st.file_uploader("Upload your Excel file", type=["xlsx"])
-        if uploaded_file is not None:
-            external_df = pd.read_excel(uploaded_file)
-            required_columns = ['Item number', 'On Hand', 'Sales Price', 'Item Name', 'Brand']
+        # Sync only on an explicit click, and only once per uploaded file
+        already_synced = uploaded_file is not None and st.session_state.get("synced_file_id") == uploaded_file.file_id
+        if already_synced:
+            st.info("This file has already been synced. Upload a new file to run another sync.")
+        elif uploaded_file is not None:
+            # Fetch the catalog as soon as a file is uploaded; the Start sync rerun then reads it from the cache
+            df = _load_products(store_name, access_token)
+        if uploaded_file is not None and not already_synced and st.button("Start sync", type="primary"):
+            external_df = _read_excel(uploaded_file)
             
-            if all(column in external_df.columns for column in required_columns):
+            if all(column in external_df.columns for column in SCHEMA.required_columns):
                 st.markdown("""
                 📂 File uploaded and validated successfully!  
                 Loading…
                 """)
                 
                 # Clean up the data
-                external_df['On Hand'] = external_df['On Hand'].apply(sync.safe_float)
-                external_df['Sales Price'] = external_df['Sales Price'].apply(sync.safe_float)
-                external_df['Brand'] = external_df['Brand'].fillna('').astype(str).str.strip()
-                external_df['Item number'] = external_df['Item number'].astype(str).str.strip().str.replace(" ", "")
+                external_df[SCHEMA.stock_column] = sync.safe_float_series(external_df[SCHEMA.stock_column])
+                external_df[SCHEMA.price_column] = sync.safe_float_series(external_df[SCHEMA.price_column])
+                external_df[SCHEMA.brand_column] = external_df[SCHEMA.brand_column].fillna('').astype(str).str.strip()
+                external_df[SCHEMA.sku_column] = clean_sku(external_df[SCHEMA.sku_column])
+                # Rows without an item number can be neither matched nor created
+                external_df = external_df[external_df[SCHEMA.sku_column].fillna('') != '']
                 
-                # Get existing products
-                df = sync.get_products()
+                # One left merge with an indicator partitions the upload into
+                # matched rows and new products from a single hash build
+                # Variants without a SKU can never match, and missing keys would join each other
+                catalog = df.loc[
+                    df['sku'].fillna('') != '',
+                    ['sku', 'title', 'product_id', 'variant_id', 'inventory_item_id', 'price', 'inventory_quantity']
+                ]
+                joined = external_df.merge(catalog, left_on=SCHEMA.sku_column, right_on='sku', how='left', indicator=True)
+                matched_mask = joined['_merge'] == 'both'
+                merged_df = joined[matched_mask].drop(columns='_merge').astype(
+                    {'product_id': 'int64', 'variant_id': 'int64', 'inventory_item_id': 'int64'}
+                )
                 
-                df['sku'] = df['sku'].astype(str).str.strip().str.replace(" ", "")
-                # Perform merge
-                merged_df = df.merge(external_df, left_on='sku', right_on='Item number', how='inner')
+                # Only matched rows whose price or stock differs from Shopify need a write.
+                # inventory_quantity is the total over all locations while stock is written to the
+                # first one, so the stock comparison only holds on single-location stores
+                stock_changed = merged_df['inventory_quantity'] != merged_df[SCHEMA.stock_column].astype(int)
+                if sync.location_count != 1:
+                    stock_changed[:] = True
+                changed = (merged_df['price'].round(2) != merged_df[SCHEMA.price_column].round(2)) | stock_changed
+                to_update = merged_df[changed]
                 
                 # Find unmatched SKUs (new products)
-                unmatched_skus = external_df[~external_df['Item number'].isin(df['sku'])]
+                unmatched_skus = joined.loc[~matched_mask, external_df.columns]
                 
                 # Show preview of updates
-                st.write(f"✅ Found {len(merged_df)} products to update:")
-                st.dataframe(merged_df[["title", "sku", "Sales Price", "On Hand"]])
+                st.write(f"✅ Found {len(to_update)} products to update ({len(merged_df) - len(to_update)} of {len(merged_df)} matched products already up to date):")
+                st.dataframe(to_update[["title", "sku", SCHEMA.price_column, SCHEMA.stock_column]])
                 
                 st.write(f"📌 Found {len(unmatched_skus)} new products to create:")
-                st.dataframe(unmatched_skus[['Item Name', 'Item number', 'Sales Price', 'On Hand', 'Brand']])
+                st.dataframe(unmatched_skus[[SCHEMA.name_column, SCHEMA.sku_column, SCHEMA.price_column, SCHEMA.stock_column, SCHEMA.brand_column]])
                 
                 # Initialize progress tracking
-                total_operations = len(merged_df) + len(unmatched_skus)
+                total_operations = len(to_update) + len(unmatched_skus)
                 progress_bar = st.progress(0)
                 status_text = st.empty()
                 completed_operations = 0
 
-                # Update existing products
-                for index, row in merged_df.iterrows():
-                    completed_operations += 1
-                    # Calculate progress as a percentage of completed operations
-                    progress = completed_operations / total_operations
-                    # Ensure progress stays within bounds
-                    progress = max(0, min(1.0, progress))
-                    progress_bar.progress(progress)
-                    status_text.text(f"Updating existing product {index + 1} of {len(merged_df)}: {row['title']}")
-                    
-                    success = sync.update_product_variant(
-                        row['variant_id'],
-                        row['Sales Price'],
-                        row['On Hand']
-                    )
-                    
-                    if not success:
-                        logging.warning(f"Failed to update {row['sku']}. Check the logs for details.")
-                    
-                    time.sleep(0.25)  # Reduced sleep time
-                
-                # Create new products
-                for index, row in unmatched_skus.iterrows():
-                    completed_operations += 1
-                    # Calculate progress as a percentage of completed operations
-                    progress = completed_operations / total_operations
-                    # Ensure progress stays within bounds
-                    progress = max(0, min(1.0, progress))
-                    progress_bar.progress(progress)
-                    status_text.text(f"Creating new product {index + 1} of {len(unmatched_skus)}: {row['Item Name']}")
-                    
-                    result = sync.create_product(
-                        title=row['Item Name'],
-                        sku=row['Item number'],
-                        price=row['Sales Price'],
-                        inventory=row['On Hand'],
-                        brand=row['Brand']
-                    )
-                    
-                    if not result:
-                        st.warning(f"Failed to create product {row['Item number']}. Check the logs for details.")
-                    
-                    time.sleep(0.25)  # Reduced sleep time
-                
+                # The create loop only fires HTTP calls, so feed it plain tuples, with blank cells as None
+                create_columns = [
+                    SCHEMA.name_column, SCHEMA.sku_column, SCHEMA.price_column,
+                    SCHEMA.stock_column, SCHEMA.brand_column
+                ]
+                new_products = unmatched_skus[create_columns]
+                create_rows = list(
+                    new_products.astype(object).where(new_products.notna(), None).itertuples(index=False, name=None)
+                )
+                updates = to_update[
+                    ['product_id', 'variant_id', 'inventory_item_id', 'sku', SCHEMA.price_column, SCHEMA.stock_column]
+                ].rename(columns={SCHEMA.price_column: 'price', SCHEMA.stock_column: 'inventory'})
+                # Pack whole products into batches so each product goes out as a single mutation
+                batches = []
+                for _, product_updates in updates.groupby('product_id', sort=False):
+                    records = product_updates.to_dict('records')
+                    if batches and len(batches[-1]) + len(records) <= GRAPHQL_BATCH_SIZE:
+                        batches[-1].extend(records)
+                    else:
+                        batches.append(records)
+                updated_count = 0
+
+                try:
+                    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+                        # Update existing products in GraphQL batches
+                        for batch in batches:
+                            if not sync.bulk_update_variants(batch):
+                                # Fall back to per-variant REST updates for this batch
+                                logging.warning("Bulk update failed, retrying batch one variant at a time")
+                                futures = {
+                                    pool.submit(
+                                        sync.update_product_variant,
+                                        update['variant_id'],
+                                        update['inventory_item_id'],
+                                        update['price'],
+                                        update['inventory']
+                                    ): update
+                                    for update in batch
+                                }
+                                for future in as_completed(futures):
+                                    if not future.result():
+                                        logging.warning("Failed to update %s. Check the logs for details.", futures[future]['sku'])
+
+                            completed_operations += len(batch)
+                            updated_count += len(batch)
+                            # Calculate progress as a percentage of completed operations
+                            progress = completed_operations / total_operations
+                            # Ensure progress stays within bounds
+                            progress = max(0, min(1.0, progress))
+                            progress_bar.progress(progress)
+                            status_text.text(f"Updated {updated_count} of {len(to_update)} existing products")
+
+                        # Create new products
+                        futures = {
+                            pool.submit(
+                                sync.create_product,
+                                title=title,
+                                sku=sku,
+                                price=price,
+                                inventory=inventory,
+                                brand=brand
+                            ): (title, sku)
+                            for title, sku, price, inventory, brand in create_rows
+                        }
+                        # Each widget update is a websocket message, so refresh only when the whole percentage changes
+                        last_percent = -1
+                        for i, future in enumerate(as_completed(futures)):
+                            title, sku = futures[future]
+                            completed_operations += 1
+                            percent = completed_operations * 100 // total_operations
+                            if percent != last_percent:
+                                progress_bar.progress(percent / 100)
+                                status_text.text(f"Created new product {i + 1} of {len(unmatched_skus)}: {title}")
+                                last_percent = percent
+
+                            if not future.result():
+                                st.warning(f"Failed to create product {sku}. Check the logs for details.")
+                finally:
+                    # Writes may have landed even if the run stopped part-way, so the cached catalog is stale
+                    _load_products.clear()
+
                 # Ensure final progress is exactly 1.0
                 progress_bar.progress(1.0)
-                st.success(f"✅ Process completed! Updated {len(merged_df)} products and created {len(unmatched_skus)} new products.")
+                st.session_state.synced_file_id = uploaded_file.file_id
+                st.success(f"✅ Process completed! Updated {len(to_update)} products and created {len(unmatched_skus)} new products.")
                 
             else:
-                st.error(f"File must contain the following columns: {required_columns}")
+                st.error(f"File must contain the following columns: {SCHEMA.required_columns}")
                 
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
-        logging.error(f"Main function error: {str(e)}")
+        logging.error("Main function error: %s", e)
+    finally:
+        if sync is not None:
+            sync.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,573 @@
+import asyncio
+import httpx
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import pandas as pd
+import re
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlparse
+from dataclasses import dataclass
+# Concurrent Shopify writes; the rate limiter keeps them inside the API budget
+MAX_WORKERS = 4
+# Columns of the catalog DataFrame, one row per variant
+PRODUCT_COLUMNS = [
+    'product_id', 'title', 'variant_id', 'price', 'sku', 'inventory_quantity',
+    'inventory_item_id', 'created_at', 'updated_at', 'status'
+]
+# Stores above this many products load the catalog through a GraphQL bulk export
+BULK_PRODUCT_THRESHOLD = 2500
+# Seconds to wait for a bulk export before falling back to REST paging
+BULK_POLL_TIMEOUT = 600
+
+BULK_PRODUCTS_QUERY = """
+mutation {
+  bulkOperationRunQuery(query: \"\"\"
+    {
+      products {
+        edges {
+          node {
+            id title status createdAt updatedAt
+            variants {
+              edges { node { id sku price inventoryQuantity inventoryItem { id } } }
+            }
+          }
+        }
+      }
+    }
+  \"\"\") {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+CURRENT_BULK_OPERATION = """
+{
+  currentBulkOperation { id status errorCode objectCount url }
+}
+"""
+
+# Whitespace removed from SKUs on both sides of the match; kept as a plain
+# pattern so pandas hands it to pyarrow's regex kernel
+SKU_WHITESPACE = r'\s+'
+# Thousands separators, currency signs and whitespace stripped from numeric cells
+NUMBER_NOISE = r'[,$£€\s]'
+# Variants per GraphQL bulk mutation (Shopify caps productVariantsBulkUpdate at 100)
+GRAPHQL_BATCH_SIZE = 100
+
+PRODUCT_VARIANTS_BULK_UPDATE = """
+mutation productVariantsBulkUpdate($productId: ID!, $variants: [ProductVariantsBulkInput!]!) {
+  productVariantsBulkUpdate(productId: $productId, variants: $variants) {
+    userErrors { field message }
+  }
+}
+"""
+
+INVENTORY_SET_QUANTITIES = """
+mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
+  inventorySetQuantities(input: $input) {
+    userErrors { field message }
+  }
+}
+"""
+
+class RateLimiter:
+    """Token bucket sized to Shopify's REST leaky bucket (2 requests/s, burst of 40)"""
+    def __init__(self, rate=2.0, capacity=40):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request slot is available"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+def _json_default(value):
+    """Send pandas' missing-value marker as null, like NaN"""
+    if value is pd.NA:
+        return None
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def _json_body(payload):
+    """Serialize a request body with orjson, accepting numpy scalars taken from pandas rows"""
+    return orjson.dumps(payload, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+def _gid_to_id(series):
+    """Turn GraphQL global IDs (gid://shopify/Product/123) into numeric REST IDs"""
+    return series.str.rsplit('/', n=1).str[1].astype('int64')
+
+def clean_sku(series):
+    """Cast SKUs to arrow strings and drop all whitespace in a single regex pass"""
+    return series.astype('string[pyarrow]').str.replace(SKU_WHITESPACE, '', regex=True)
+
+@dataclass(frozen=True)
+class StockSchema:
+    """Column names of the uploaded stock workbook"""
+    sku_column: str = 'Item number'
+    stock_column: str = 'On Hand'
+    price_column: str = 'Sales Price'
+    name_column: str = 'Item Name'
+    brand_column: str = 'Brand'
+
+    @property
+    def required_columns(self):
+        return [self.sku_column, self.stock_column, self.price_column, self.name_column, self.brand_column]
+
+class ShopifyProductSync:
+    def __init__(self, store_name, access_token):
+        self.store_name = store_name
+        self.access_token = access_token
+        self.base_url = f"https://{store_name}.myshopify.com/admin/api/2024-01/products.json"
+        self.graphql_path = "/admin/api/2024-01/graphql.json"
+        self.headers = {
+            "Content-Type": "application/json",
+            "X-Shopify-Access-Token": access_token
+        }
+        # Reuse pooled keep-alive connections instead of a new TLS handshake per call
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # 429s are left to _req_with_retry and the paging loop, which wait on the rate limiter and Retry-After
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+        )
+        self.session.mount("https://", adapter)
+        # GraphQL mutations share one HTTP/2 connection instead of queueing on HTTP/1.1
+        self.http = httpx.Client(
+            http2=True,
+            base_url=f"https://{store_name}.myshopify.com",
+            headers=self.headers,
+            limits=httpx.Limits(max_keepalive_connections=20),
+            timeout=30.0
+        )
+        self.rate_limiter = RateLimiter()
+        self._location_id = None
+        # Number of store locations, known once location_id has been fetched
+        self.location_count = None
+
+    def close(self):
+        """Release pooled HTTP connections"""
+        self.session.close()
+        self.http.close()
+
+    @property
+    def location_id(self):
+        """First store location, fetched on first use and then reused for the whole run"""
+        if self._location_id is None:
+            self._location_id = self.get_location_id()
+        return self._location_id
+
+    def get_location_id(self):
+        """Get the first location ID from the store"""
+        url = f"https://{self.store_name}.myshopify.com/admin/api/2024-01/locations.json"
+        response = self._req_with_retry('GET', url)
+
+        if response.status_code == 200:
+            locations = orjson.loads(response.content).get('locations', [])
+            self.location_count = len(locations)
+            if locations:
+                location_id = locations[0]['id']
+                logging.info("Retrieved location ID: %s", location_id)
+                return location_id
+
+        logging.error("Failed to get location ID")
+        return None
+    def _throttle(self, response):
+        """Back off only when Shopify reports the REST call bucket is nearly full"""
+        if response.status_code == 429:
+            time.sleep(float(response.headers.get('Retry-After', 2)))
+            return
+        call_limit = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+        if not call_limit:
+            return
+        try:
+            used, cap = (int(part) for part in call_limit.split('/'))
+        except ValueError:
+            return
+        if used / cap > 0.8:
+            time.sleep((used / cap - 0.8) * 2)
+    def _req_with_retry(self, method, url, retries=3, **kwargs):
+        """Send a rate-limited REST request, retrying 429s after the Retry-After delay Shopify asks for"""
+        for attempt in range(retries + 1):
+            self.rate_limiter.acquire()
+            response = self.session.request(method, url, **kwargs)
+            if response.status_code != 429:
+                self._throttle(response)
+                break
+            if attempt < retries:
+                logging.warning("%s %s throttled, retrying", method, url)
+                # _throttle sleeps out Retry-After on a 429
+                self._throttle(response)
+        return response
+    def set_inventory_level(self, inventory_item_id, new_quantity):
+        """Set inventory level directly using the inventory levels set endpoint"""
+        if not self.location_id:
+            logging.error("No location ID available")
+            return False
+        set_url = f"https://{self.store_name}.myshopify.com/admin/api/2024-01/inventory_levels/set.json"
+
+        data = {
+            "location_id": self.location_id,
+            "inventory_item_id": inventory_item_id,
+            "available": int(new_quantity)
+        }
+
+        try:
+            response = self._req_with_retry('POST', set_url, data=_json_body(data))
+            if response.status_code == 200:
+                logging.info("Successfully set inventory for item %s to %s", inventory_item_id, new_quantity)
+                return True
+            else:
+                logging.error("Failed to set inventory: Status %s, Response: %s", response.status_code, response.text)
+                return False
+        except Exception as e:
+            logging.error("Error setting inventory: %s", e)
+            return False
+    def safe_float(self, value, default=0):
+        """Safely convert value to float, handling None, NaN, and string numbers with commas"""
+        if pd.isna(value) or value == '':
+            return default
+        if isinstance(value, str):
+            value = re.sub(NUMBER_NOISE, '', value)
+        try:
+            return float(value)
+        except (ValueError, TypeError):
+            return default
+    def safe_float_series(self, series, default=0):
+        """Vectorized safe_float for a whole column, parsed in one pass instead of per cell"""
+        # Dirty POS exports are cleaned by pyarrow's regex kernel rather than a Python loop
+        cleaned = series.astype('string[pyarrow]').str.replace(NUMBER_NOISE, '', regex=True)
+        return pd.to_numeric(cleaned, errors='coerce').fillna(default).astype('float64')
+    def update_product_variant(self, variant_id, inventory_item_id, new_price, new_inventory):
+        """Update price and inventory of a product variant on Shopify"""
+        try:
+            # Update price
+            update_url = f"https://{self.store_name}.myshopify.com/admin/api/2024-01/variants/{variant_id}.json"
+            price_data = {
+                "variant": {
+                    "id": variant_id,
+                    "price": self.safe_float(new_price)
+                }
+            }
+
+            price_response = self._req_with_retry('PUT', update_url, data=_json_body(price_data))
+            if price_response.status_code != 200:
+                logging.error("Failed to update price for variant %s", variant_id)
+                return False
+            # Update inventory separately
+            inventory_success = self.set_inventory_level(inventory_item_id, new_inventory)
+
+            if inventory_success:
+                logging.info("Successfully updated variant %s price and inventory", variant_id)
+                return True
+            else:
+                logging.error("Failed to update inventory for variant %s", variant_id)
+                return False
+        except Exception as e:
+            logging.error("Error in update_product_variant: %s", e)
+            return False
+    def _graphql_outcome(self, response):
+        """Interpret a GraphQL response as (data, retry_after); data is None on failure"""
+        if response.status_code != 200:
+            logging.error("GraphQL request failed: Status %s, Response: %s", response.status_code, response.text)
+            return None, None
+        payload = orjson.loads(response.content)
+        errors = payload.get('errors')
+        if errors and any(error.get('extensions', {}).get('code') == 'THROTTLED' for error in errors):
+            # Wait until the cost bucket has refilled enough for this query
+            cost = payload.get('extensions', {}).get('cost', {})
+            throttle_status = cost.get('throttleStatus', {})
+            deficit = cost.get('requestedQueryCost', 0) - throttle_status.get('currentlyAvailable', 0)
+            return None, max(1, deficit / throttle_status.get('restoreRate', 50))
+        if errors:
+            logging.error("GraphQL request failed: %s", errors)
+            return None, None
+        return payload.get('data'), None
+    def graphql(self, query, variables=None):
+        """Run a GraphQL Admin API request, waiting out cost throttling; returns the data payload or None"""
+        for attempt in range(3):
+            response = self.http.post(self.graphql_path, content=_json_body({"query": query, "variables": variables or {}}))
+            data, retry_after = self._graphql_outcome(response)
+            if retry_after is None:
+                return data
+            time.sleep(retry_after)
+        logging.error("GraphQL request still throttled after retries")
+        return None
+    async def graphql_async(self, client, query, variables=None):
+        """Async counterpart of graphql() running on an httpx.AsyncClient"""
+        for attempt in range(3):
+            response = await client.post(self.graphql_path, content=_json_body({"query": query, "variables": variables or {}}))
+            data, retry_after = self._graphql_outcome(response)
+            if retry_after is None:
+                return data
+            await asyncio.sleep(retry_after)
+        logging.error("GraphQL request still throttled after retries")
+        return None
+    async def _update_prices_async(self, variants_by_product):
+        """Fan out one productVariantsBulkUpdate per product over a shared HTTP/2 connection"""
+        semaphore = asyncio.Semaphore(MAX_WORKERS)
+        # Pool size matches the semaphore, so no idle connections are opened beyond the fan-out
+        client = httpx.AsyncClient(
+            http2=True,
+            base_url=f"https://{self.store_name}.myshopify.com",
+            headers=self.headers,
+            limits=httpx.Limits(max_connections=MAX_WORKERS, max_keepalive_connections=MAX_WORKERS),
+            timeout=30.0
+        )
+
+        async def update_product(product_id, variants):
+            async with semaphore:
+                data = await self.graphql_async(client, PRODUCT_VARIANTS_BULK_UPDATE, {
+                    "productId": f"gid://shopify/Product/{product_id}",
+                    "variants": variants
+                })
+            return self._mutation_succeeded(data, 'productVariantsBulkUpdate')
+
+        # productVariantsBulkUpdate takes at most GRAPHQL_BATCH_SIZE variants per call
+        calls = []
+        for product_id, variants in variants_by_product.items():
+            variants = list(variants.values())
+            for start in range(0, len(variants), GRAPHQL_BATCH_SIZE):
+                calls.append(update_product(product_id, variants[start:start + GRAPHQL_BATCH_SIZE]))
+        try:
+            results = await asyncio.gather(*calls)
+        finally:
+            await client.aclose()
+        return all(results)
+    def _mutation_succeeded(self, data, name):
+        """Check a mutation result for transport and user errors"""
+        if data is None:
+            return False
+        user_errors = (data.get(name) or {}).get('userErrors', [])
+        if user_errors:
+            logging.error("%s returned errors: %s", name, user_errors)
+            return False
+        return True
+    def bulk_update_variants(self, updates):
+        """Update price and inventory of many variants with batched GraphQL mutations.
+
+        Each update is a dict with product_id, variant_id, inventory_item_id, price and inventory.
+        Prices go out as concurrent productVariantsBulkUpdate calls (one per product), inventory as
+        inventorySetQuantities calls of up to GRAPHQL_BATCH_SIZE items.
+        """
+        if not self.location_id:
+            logging.error("No location ID available")
+            return False
+        success = True
+        try:
+            # Later rows win when the same variant appears more than once
+            variants_by_product = {}
+            quantities = {}
+            for update in updates:
+                variants_by_product.setdefault(update['product_id'], {})[update['variant_id']] = {
+                    "id": f"gid://shopify/ProductVariant/{update['variant_id']}",
+                    "price": str(self.safe_float(update['price']))
+                }
+                quantities[update['inventory_item_id']] = {
+                    "inventoryItemId": f"gid://shopify/InventoryItem/{update['inventory_item_id']}",
+                    "locationId": f"gid://shopify/Location/{self.location_id}",
+                    "quantity": int(self.safe_float(update['inventory']))
+                }
+
+            if not asyncio.run(self._update_prices_async(variants_by_product)):
+                success = False
+
+            quantities = list(quantities.values())
+            for start in range(0, len(quantities), GRAPHQL_BATCH_SIZE):
+                data = self.graphql(INVENTORY_SET_QUANTITIES, {
+                    "input": {
+                        "name": "available",
+                        "reason": "correction",
+                        "ignoreCompareQuantity": True,
+                        "quantities": quantities[start:start + GRAPHQL_BATCH_SIZE]
+                    }
+                })
+                if not self._mutation_succeeded(data, 'inventorySetQuantities'):
+                    success = False
+
+            if success:
+                logging.info("Bulk updated price and inventory for %s variants", len(updates))
+            return success
+        except Exception as e:
+            logging.error("Error in bulk_update_variants: %s", e)
+            return False
+    def _finalize_catalog(self, df):
+        """Apply the catalog column types shared by the REST and bulk fetch paths"""
+        # IDs arrive as generic objects from json_normalize meta fields; pin them to int64
+        df = df.astype({'product_id': 'int64', 'variant_id': 'int64', 'inventory_item_id': 'int64'})
+        df['price'] = df['price'].astype(float)
+        df['status'] = df['status'].fillna('active')
+        df['created_at'] = pd.to_datetime(df['created_at'], format='ISO8601', errors='coerce', utc=True)
+        df['updated_at'] = pd.to_datetime(df['updated_at'], format='ISO8601', errors='coerce', utc=True)
+        # Compact dtypes keep the frame small for the merge and the Streamlit cache
+        df['inventory_quantity'] = pd.to_numeric(df['inventory_quantity'], errors='coerce').fillna(0).astype('int32')
+        df['status'] = df['status'].astype('category')
+        df['sku'] = clean_sku(df['sku'])
+        return df
+    def _page_to_frame(self, products):
+        """Flatten one page of REST products to one row per variant"""
+        page_df = pd.json_normalize(
+            products,
+            record_path='variants',
+            meta=['id', 'title', 'created_at', 'updated_at', 'status'],
+            meta_prefix='product.',
+            errors='ignore'
+        ).reindex(columns=[
+            'product.id', 'product.title', 'id', 'price', 'sku', 'inventory_quantity',
+            'inventory_item_id', 'product.created_at', 'product.updated_at', 'product.status'
+        ])
+        page_df.columns = PRODUCT_COLUMNS
+        return page_df
+    def get_products(self):
+        """Retrieve products from Shopify API"""
+        try:
+            chunks = []
+            product_count = 0
+            params = {'limit': 250}
+            page_count = 1
+            # A single background worker downloads the next page while the current one is parsed
+            with ThreadPoolExecutor(max_workers=1) as prefetcher:
+                pending = prefetcher.submit(self.session.get, self.base_url, params=params)
+                while True:
+                    response = pending.result()
+                    logging.info("Fetching page %s", page_count)
+                    if response.status_code == 200:
+                        # requests parses the Link header into {rel: {'url': ...}}
+                        next_url = response.links.get('next', {}).get('url')
+                        if next_url:
+                            params = dict(parse_qsl(urlparse(next_url).query))
+                            pending = prefetcher.submit(self.session.get, self.base_url, params=params)
+                        data = orjson.loads(response.content)
+                        # Release the raw page bytes once parsed
+                        del response
+                        current_products = data.get('products', [])
+                        if current_products:
+                            chunks.append(self._page_to_frame(current_products))
+                        product_count += len(current_products)
+                        print(f"Retrieved {len(current_products)} products from page {page_count}")
+                        # Only the flattened frame outlives the page; drop the parsed JSON before the next one arrives
+                        del data, current_products
+                        if not next_url:
+                            break
+                        page_count += 1
+                    elif response.status_code == 429:
+                        retry_after = int(response.headers.get('Retry-After', 10))
+                        time.sleep(retry_after)
+                        pending = prefetcher.submit(self.session.get, self.base_url, params=params)
+                    else:
+                        logging.error("API request failed with status code: %s", response.status_code)
+                        response.raise_for_status()
+                        # A truncated catalog would turn every SKU on the missing pages into a new product
+                        raise RuntimeError(f"Unexpected status {response.status_code} while paging products")
+            print(f"Successfully retrieved {product_count} products")
+            if not chunks:
+                return self._finalize_catalog(pd.DataFrame(columns=PRODUCT_COLUMNS))
+            df = self._finalize_catalog(pd.concat(chunks, ignore_index=True, copy=False))
+            return df
+
+        except Exception as e:
+            logging.error("Error retrieving products: %s", e)
+            raise
+
+    def get_product_count(self):
+        """Return the number of products in the store, or None if the count is unavailable"""
+        url = f"https://{self.store_name}.myshopify.com/admin/api/2024-01/products/count.json"
+        response = self._req_with_retry('GET', url)
+        if response.status_code == 200:
+            return orjson.loads(response.content).get('count')
+        logging.error("Failed to get product count: Status %s", response.status_code)
+        return None
+
+    def get_products_bulk(self):
+        """Retrieve the whole catalog with a GraphQL bulk operation; returns None if it cannot run"""
+        try:
+            data = self.graphql(BULK_PRODUCTS_QUERY)
+            if not self._mutation_succeeded(data, 'bulkOperationRunQuery'):
+                return None
+
+            # Shopify builds the export asynchronously; poll until it is ready
+            deadline = time.monotonic() + BULK_POLL_TIMEOUT
+            while True:
+                time.sleep(1)
+                data = self.graphql(CURRENT_BULK_OPERATION)
+                operation = (data or {}).get('currentBulkOperation') or {}
+                status = operation.get('status')
+                if status == 'COMPLETED':
+                    break
+                if status not in ('CREATED', 'RUNNING') or time.monotonic() > deadline:
+                    logging.error("Bulk product export did not complete: %s", operation)
+                    return None
+
+            url = operation.get('url')
+            if not url:
+                # No objects matched, so Shopify produced no file
+                return self._finalize_catalog(pd.DataFrame(columns=PRODUCT_COLUMNS))
+
+            # The export is signed-URL storage, so it is fetched without the store session headers
+            lines = pd.read_json(url, lines=True, dtype=False, convert_dates=False)
+            is_variant = lines['__parentId'].notna()
+            products = lines.loc[~is_variant].set_index('id')[['title', 'createdAt', 'updatedAt', 'status']]
+            variants = lines.loc[is_variant, ['id', 'sku', 'price', 'inventoryQuantity', 'inventoryItem', '__parentId']]
+            variants = variants.join(products, on='__parentId')
+
+            df = pd.DataFrame({
+                'product_id': _gid_to_id(variants['__parentId']),
+                'title': variants['title'],
+                'variant_id': _gid_to_id(variants['id']),
+                'price': variants['price'],
+                'sku': variants['sku'],
+                'inventory_quantity': variants['inventoryQuantity'],
+                'inventory_item_id': _gid_to_id(variants['inventoryItem'].str.get('id')),
+                'created_at': variants['createdAt'],
+                'updated_at': variants['updatedAt'],
+                'status': variants['status'].str.lower()
+            }).reset_index(drop=True)
+            logging.info("Successfully retrieved %s products via bulk operation", len(products))
+            return self._finalize_catalog(df)
+
+        except Exception as e:
+            logging.error("Error retrieving products in bulk: %s", e)
+            return None
+
+    def create_product(self, title, sku, price, inventory, brand):
+        """Create a new product in Shopify with the given brand."""
+        # Convert and validate the values
+        safe_price = self.safe_float(price)
+        safe_inventory = int(self.safe_float(inventory))  # Convert to integer for inventory
+        data = {
+            "product": {
+                "title": title,
+                "status": "draft",
+                #"vendor": brand.strip() if isinstance(brand, str) else brand,  # Clean up brand name
+                "variants": [{
+                    "sku": sku,
+                    "price": safe_price,
+                    "inventory_quantity": safe_inventory,
+                    "inventory_management": "shopify",  # Enable inventory tracking
+                    "inventory_policy": "deny",  # Prevent selling when out of stock
+                    "requires_shipping": True
+                }]
+            }
+        }
+        response = self._req_with_retry('POST', self.base_url, data=_json_body(data))
+        if response.status_code == 201:
+            logging.info("Created new product '%s' with SKU %s and Brand '%s'", title, sku, brand)
+            return orjson.loads(response.content)
+        else:
+            logging.error("Failed to create product %s: %s", title, response.text)
+            return None